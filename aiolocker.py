@@ -0,0 +1,253 @@
+"""
+asyncio versions of the blocking calls in locker and athdir, for use
+from an event loop.  Blocking Hesiod, AFS and filesystem calls are
+run in a bounded thread pool; aklog and machtype are run as asyncio
+subprocesses.  (Requires Python 3.7 or later.)
+"""
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import os
+import weakref
+
+import athdir
+import locker
+
+logger = logging.getLogger('aiolocker')
+
+class Runner(object):
+    """
+    Runs the blocking calls and subprocesses for the coroutines in
+    this module.  At most workers blocking calls, and at most
+    subprocesses subprocesses (per event loop), run at once; anything
+    else waits its turn without blocking the loop.
+
+    The workers limit covers the calls themselves.  Each AFS call a
+    worker makes also runs in a short-lived thread of its own, so that
+    locker can enforce its deadline (see locker.configureAFS()); a call
+    which misses the deadline leaves that thread behind until AFS
+    answers.
+    """
+    def __init__(self, workers=16, subprocesses=4):
+        self.workers = workers
+        self.subprocesses = subprocesses
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers)
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _semaphore(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.subprocesses)
+        return self._semaphores[loop]
+
+    async def call(self, func, *args, **kwargs):
+        """
+        Run func(*args, **kwargs) in the thread pool.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs))
+
+    async def run(self, cmdline):
+        """
+        Run cmdline, and return a tuple of (returncode, stdout, stderr).
+
+        Raises: OSError if the command cannot be run.
+        """
+        async with self._semaphore():
+            proc = await asyncio.create_subprocess_exec(
+                *cmdline, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE)
+            try:
+                (out, err) = await proc.communicate()
+            except BaseException:
+                # Don't leave a hung aklog behind if we are cancelled
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                raise
+        return (proc.returncode, out, err)
+
+    def shutdown(self):
+        """
+        Stop accepting calls.  Calls already running are not waited for.
+        """
+        self._executor.shutdown(wait=False)
+
+_runner = Runner()
+
+def configure(workers=16, subprocesses=4):
+    """
+    Set the concurrency limits for the coroutines in this module.
+    """
+    global _runner
+    old = _runner
+    _runner = Runner(workers, subprocesses)
+    old.shutdown()
+
+def _get(runner):
+    return runner if runner is not None else _runner
+
+async def resolve(name, runner=None):
+    """
+    Like locker.resolve().
+    """
+    return await _get(runner).call(locker.resolve, name)
+
+async def lookup(name, runner=None):
+    """
+    Like locker.lookup().
+    """
+    return await _get(runner).call(locker.lookup, name)
+
+async def _runAuth(l, cmdline, runner):
+    if cmdline is None:
+        return
+    try:
+        (rc, out, err) = await _get(runner).run(cmdline)
+    except OSError as e:
+        raise locker.NamedLockerError(l.name, "Unable to run %s: %s" % \
+                                      (cmdline[0], e.strerror))
+    if rc != 0:
+        raise locker.NamedLockerError(l.name, "%s failed with status %d" % \
+                                      (cmdline[0], rc))
+
+async def authenticate(l, runner=None):
+    """
+    Run the command to authenticate to a locker (e.g. aklog), if any.
+
+    Raises: NamedLockerError if it fails.
+    """
+    await _runAuth(l, l.getAuthCommandline(), runner)
+
+async def deauthenticate(l, runner=None):
+    """
+    Run the command to remove authentication to a locker, if any.
+
+    Raises: NamedLockerError if it fails.
+    """
+    await _runAuth(l, l.getDeauthCommandline(), runner)
+
+async def attach(l, runner=None, **kwargs):
+    """
+    Like l.attach().
+    """
+    return await _get(runner).call(l.attach, **kwargs)
+
+async def detach(l, runner=None):
+    """
+    Like l.detach().
+    """
+    return await _get(runner).call(l.detach)
+
+async def getQuota(l, runner=None):
+    """
+    Like l.getQuota().
+    """
+    return await _get(runner).call(l.getQuota)
+
+async def getFileServers(l, runner=None):
+    """
+    Like l.getFileServers().
+    """
+    return await _get(runner).call(l.getFileServers)
+
+async def getZephyrTriplets(l, runner=None):
+    """
+    Like l.getZephyrTriplets().
+    """
+    return await _get(runner).call(l.getZephyrTriplets)
+
+async def read_attachtab(mountpoint=locker._mountpoint, runner=None):
+    """
+    Like locker.read_attachtab().
+    """
+    return await _get(runner).call(locker.read_attachtab, mountpoint)
+
+async def fileServerIndex(lockers, runner=None):
+    """
+    Like locker.FileServerIndex(lockers), asking each locker for its
+    file servers through the runner.
+    """
+    runner = _get(runner)
+    index = locker.FileServerIndex(None, runner.workers)
+    keys = list(lockers.keys())
+    results = await asyncio.gather(
+        *[runner.call(lockers[k].getFileServers) for k in keys],
+        return_exceptions=True)
+    for (k, r) in zip(keys, results):
+        if isinstance(r, BaseException):
+            index.add(k, None, r)
+        else:
+            index.add(k, r)
+    return index
+
+async def lockersOn(index, host, runner=None):
+    """
+    Like index.lockersOn(host), for a FileServerIndex, doing any host
+    lookups through the runner.
+    """
+    runner = _get(runner)
+    wanted = await runner.call(index.hostCache.identities, host, True)
+    servers = index.matching(wanted)
+    if len(servers) == 0:
+        others = index.servers()
+        identities = await asyncio.gather(
+            *[runner.call(index.hostCache.identities, s) for s in others])
+        servers = [s for (s, ids) in zip(others, identities)
+                   if len(wanted.intersection(ids)) > 0]
+    return index.lockersFor(servers)
+
+async def machtype(arg=None, runner=None):
+    """
+    Like athdir._machtype(): run machtype, first from PATH and then
+    explicitly, and return its output, or None if it cannot be run.
+    """
+    for cmd in ['machtype', '/bin/machtype']:
+        cmdline = [cmd]
+        if arg is not None:
+            cmdline.append(arg)
+        try:
+            (rc, out, err) = await _get(runner).run(cmdline)
+            return out.decode().strip()
+        except OSError as e:
+            logger.info(e)
+    return None
+
+async def makeAthdir(basePath='%p', dirType='%t', customTemplate=None,
+                     sysName=None, hostType=None, runner=None):
+    """
+    Like athdir.Athdir(), but determines the sysname, compatibility
+    list and host type (if they are not in the environment) without
+    blocking.
+
+    Raises: AthdirInternalError if they cannot be determined.
+    """
+    if sysName is None:
+        sysName = os.getenv("ATHENA_SYS")
+    if sysName is None:
+        sysName = await machtype('-S', runner)
+        if sysName is None:
+            raise athdir.AthdirInternalError("Unable to determine sysname.")
+    compat = os.getenv("ATHENA_SYS_COMPAT")
+    if compat is None:
+        compat = await machtype('-C', runner)
+        if compat is None:
+            raise athdir.AthdirInternalError("Unable to determine sysname compatibility list.")
+    if hostType is None:
+        hostType = os.getenv("HOSTTYPE")
+    if hostType is None:
+        hostType = await machtype(None, runner)
+        if hostType is None:
+            raise athdir.AthdirInternalError("Unable to determine host type.")
+    return athdir.Athdir(basePath, dirType, customTemplate, sysName,
+                         hostType, compat.split(':'))
+
+async def get_paths(adir, runner=None, **kwargs):
+    """
+    Like adir.get_paths(), which checks the filesystem for each
+    candidate path.
+    """
+    return await _get(runner).call(adir.get_paths, **kwargs)
@@ -104,10 +104,11 @@ class Athdir():
                     AthdirConvention("%p/%t"))
 
     def __init__(self, basePath='%p', dirType='%t', customTemplate=None,
-                 sysName=None, hostType=None):
+                 sysName=None, hostType=None, sysCompat=None):
         self.path = basePath
         self.dirType = dirType
-        self.compatlist = [sysName if sysName is not None else self.sysname()] + self.syscompatlist()
+        self.compatlist = [sysName if sysName is not None else self.sysname()] + \
+            (sysCompat if sysCompat is not None else self.syscompatlist())
         self.hostType = hostType if hostType is not None else self.hosttype()
         # for unknown types, assume arch dependent
         self.archDependent = not dirType in self._indepTypes
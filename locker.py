@@ -4,8 +4,19 @@ A modern re-interpretation of Athena's liblocker, in Python.
 from __future__ import division
 import math
 import errno, re, os, pwd
+import json
 import logging
+import mmap
+import socket
+import struct
+import tempfile
+import threading
+import time
 import warnings
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import afs.fs
 import hesiod
@@ -14,6 +25,10 @@ logger = logging.getLogger('locker')
 
 _classNameRE = re.compile(r'([A-Z]+)Locker')
 _mountpoint = '/mit'
+# Deadline (in seconds) for any single afs.fs call.  None means wait forever.
+_afsTimeout = 10
+# Deadline for finding out which file servers to blame for a timeout
+_afsLocateTimeout = 2
 
 class LockerError(Exception):
     """
@@ -65,6 +80,15 @@ class LockerUnavailableError(NamedLockerError):
     def __init__(self, name, message="Locker unavailable."):
         NamedLockerError.__init__(self, name, message)
 
+class LockerTimeoutError(LockerUnavailableError):
+    """
+    An operation on the locker did not finish before its deadline.
+    """
+    def __init__(self, name, operation, timeout):
+        LockerUnavailableError.__init__(self, name,
+                                        "Timed out after %ss during %s." % \
+                                        (timeout, operation))
+
 class LockerQuota(dict):
     """
     Object for storing locker quota, in an extensible manner, that
@@ -106,6 +130,271 @@ class LockerQuota(dict):
             i /= self['units']
         return "%.1f %s" % (i, _suffixes[power])
 
+def _withDeadline(timeout, func, *args):
+    """
+    Call func(*args) in a separate thread and wait at most timeout
+    seconds for it.  Returns a tuple of (finished, result).  Exceptions
+    raised by func are re-raised in the caller.  A call which misses its
+    deadline is abandoned, not killed; the thread is a daemon, so it
+    will not keep the process alive.
+    """
+    if timeout is None:
+        return (True, func(*args))
+    outcome = {}
+    def target():
+        try:
+            outcome['result'] = func(*args)
+        except Exception as e:
+            outcome['error'] = e
+    t = threading.Thread(target=target)
+    t.daemon = True
+    t.start()
+    t.join(timeout)
+    if t.is_alive():
+        return (False, None)
+    if 'error' in outcome:
+        raise outcome['error']
+    return (True, outcome['result'])
+
+def _concurrently(func, items, workers=8):
+    """
+    Call func on each item, using up to workers threads.  Returns a
+    list of (result, exception) tuples in the same order as items,
+    where exception is None if the call succeeded.
+    """
+    items = list(items)
+    rv = [None] * len(items)
+    pending = queue.Queue()
+    for i in range(len(items)):
+        pending.put(i)
+    def worker():
+        while True:
+            try:
+                i = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                rv[i] = (func(items[i]), None)
+            except Exception as e:
+                rv[i] = (None, e)
+    threads = [threading.Thread(target=worker)
+               for x in range(min(workers, len(items)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return rv
+
+class FileServerHealth(object):
+    """
+    Keep track of AFS file servers which have recently stopped
+    answering, so that lockers they host can fail immediately instead
+    of waiting out the deadline again.  Once a dead server's cool-down
+    has elapsed, it is probed in the background and, if it answers,
+    marked alive again.
+
+    A timeout on a path served by a single server marks that server
+    dead.  A timeout on a replicated path is shared out between its
+    servers (except those recently seen answering), so that one
+    timeout does not kill healthy replicas along with the bad one.
+
+    If statefile is specified, the state is also saved there (and
+    entries older than ttl seconds are ignored on load), so that
+    back-to-back commands share what they learned.
+    """
+    def __init__(self, cooldown=60, statefile=None, ttl=300):
+        self.cooldown = cooldown
+        self.statefile = statefile
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._saveLock = threading.Lock()
+        # server -> time it was last seen failing
+        self._dead = {}
+        # server -> (share of a timeout blamed on it, time last blamed)
+        self._strikes = {}
+        # server -> time it was last seen answering
+        self._good = {}
+        # path -> (list of servers, time learned)
+        self._servers = {}
+        self._probing = set()
+        self._load()
+
+    def _load(self):
+        if self.statefile is None:
+            return
+        try:
+            with open(self.statefile, 'r') as f:
+                state = json.load(f)
+        except (IOError, ValueError) as e:
+            logger.debug("Ignoring file server state in %s: %s",
+                         self.statefile, e)
+            return
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            for server, when in state.get('dead', {}).items():
+                if when > cutoff:
+                    self._dead[server] = when
+            for path, (servers, when) in state.get('servers', {}).items():
+                if when > cutoff:
+                    self._servers[path] = (servers, when)
+
+    def _save(self):
+        if self.statefile is None:
+            return
+        # Saves are serialized from copy to rename, so that an older
+        # copy of the state can never replace a newer one.
+        with self._saveLock:
+            with self._lock:
+                state = {'dead': dict(self._dead),
+                         'servers': dict(self._servers)}
+            try:
+                directory = os.path.dirname(os.path.abspath(self.statefile))
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                (fd, tmp) = tempfile.mkstemp(dir=directory)
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(state, f)
+                os.rename(tmp, self.statefile)
+            except (IOError, OSError) as e:
+                logger.debug("Unable to save file server state to %s: %s",
+                             self.statefile, e)
+
+    def learn(self, path, servers):
+        """
+        Remember which file servers serve a path.
+        """
+        with self._lock:
+            self._servers[path] = (list(servers), time.time())
+        self._save()
+
+    def serversFor(self, path):
+        """
+        Return the file servers last known to serve a path.
+        """
+        with self._lock:
+            return list(self._servers.get(path, ([], 0))[0])
+
+    def failed(self, path):
+        """
+        Blame the file servers for a path for a timeout, marking them
+        dead once they have accumulated a whole one.
+        """
+        servers = self.serversFor(path)
+        if len(servers) == 0:
+            return
+        now = time.time()
+        with self._lock:
+            suspects = [s for s in servers
+                        if now - self._good.get(s, 0) >= self.cooldown]
+            if len(suspects) == 0:
+                suspects = servers
+            for s in suspects:
+                (strikes, when) = self._strikes.get(s, (0, now))
+                if now - when >= self.cooldown:
+                    strikes = 0
+                strikes += 1.0 / len(suspects)
+                self._strikes[s] = (strikes, now)
+                # Allow for rounding when 1/n is added up n times
+                if strikes > 0.999 or s in self._dead:
+                    logger.debug("Marking file server %s dead", s)
+                    self._dead[s] = now
+        self._save()
+
+    def succeeded(self, path):
+        """
+        Note that a call on a path was answered.  For a path on a
+        single server, that server is alive.  For a replicated path,
+        we only know that some replica answered, so its servers are
+        only revived if they were all thought dead.
+        """
+        servers = self.serversFor(path)
+        now = time.time()
+        with self._lock:
+            if len(servers) == 1:
+                self._good[servers[0]] = now
+                self._strikes.pop(servers[0], None)
+                revived = [s for s in servers if s in self._dead]
+            elif False not in [s in self._dead for s in servers]:
+                revived = servers
+            else:
+                revived = []
+            for s in revived:
+                logger.debug("File server %s is back", s)
+                del self._dead[s]
+                self._strikes.pop(s, None)
+        if len(revived):
+            self._save()
+
+    def anyDown(self):
+        """
+        Return True if any file server is currently thought dead.
+        """
+        with self._lock:
+            return len(self._dead) > 0
+
+    def isDown(self, path):
+        """
+        Return True if every known file server for a path is dead.
+        Kicks off a background probe if the cool-down has elapsed.
+        """
+        servers = self.serversFor(path)
+        if len(servers) == 0:
+            return False
+        now = time.time()
+        with self._lock:
+            if False in [s in self._dead for s in servers]:
+                return False
+            if path in self._probing or \
+                    now - min([self._dead[s] for s in servers]) < self.cooldown:
+                return True
+            self._probing.add(path)
+        t = threading.Thread(target=self._probe, args=(path,))
+        t.daemon = True
+        t.start()
+        return True
+
+    def _probe(self, path):
+        try:
+            try:
+                (finished, result) = _withDeadline(_afsTimeout,
+                                                   afs.fs.examine, path)
+            except OSError as e:
+                logger.debug("Probe of %s failed: %s", path, e)
+                finished = False
+            if finished:
+                self.succeeded(path)
+            else:
+                self.failed(path)
+        finally:
+            with self._lock:
+                self._probing.discard(path)
+
+_afsHealth = FileServerHealth()
+
+def defaultAFSStateFile():
+    """
+    Return where the commands keep file server health between runs:
+    $LOCKER_AFS_STATE if it is set, and otherwise a file in the user's
+    cache directory.
+    """
+    statefile = os.getenv("LOCKER_AFS_STATE")
+    if statefile:
+        return statefile
+    cache = os.getenv("XDG_CACHE_HOME",
+                      os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache, 'locker', 'afs-health.json')
+
+def configureAFS(timeout=10, cooldown=60, statefile=None):
+    """
+    Set the deadline for AFS calls, and how long a file server which
+    missed it is considered dead before it is probed again.  If
+    statefile is specified, file server health is shared through it.
+    """
+    global _afsTimeout, _afsHealth
+    _afsTimeout = timeout
+    _afsHealth = FileServerHealth(cooldown, statefile)
+
 class Locker(object):
     def __init__(self, name, data):
         self.name = name
@@ -263,45 +552,107 @@ class AFSLocker(Locker):
     def getAuthCommandline(self):
         return ['aklog', '-path', self.path]
 
+    def _afs(self, operation, func, *args):
+        """
+        Run an afs.fs call for this locker under the configured
+        deadline, failing fast if its file servers are known to be down.
+        """
+        # Once some server is dead, it is worth finding out whether
+        # this locker is on it before waiting out another deadline.
+        if _afsHealth.anyDown() and func is not afs.fs.whereis and \
+                len(_afsHealth.serversFor(self.path)) == 0:
+            self._locate()
+        if _afsHealth.isDown(self.path):
+            raise LockerUnavailableError(self.name,
+                                         "File server(s) %s not responding." % \
+                                         (', '.join(_afsHealth.serversFor(self.path))))
+        (finished, result) = _withDeadline(_afsTimeout, func, *args)
+        if not finished:
+            if func is not afs.fs.whereis and \
+                    len(_afsHealth.serversFor(self.path)) == 0:
+                self._locate()
+            _afsHealth.failed(self.path)
+            raise LockerTimeoutError(self.name, operation, _afsTimeout)
+        if func is afs.fs.whereis:
+            _afsHealth.learn(self.path, result)
+        # Calls on other paths (e.g. the parent volume) say nothing
+        # about this locker's servers.
+        if len(args) and args[0] == self.path:
+            _afsHealth.succeeded(self.path)
+        return result
+
+    def _locate(self):
+        """
+        Find out which file servers to blame for a timeout, giving up
+        quickly if that does not work either.
+        """
+        try:
+            (finished, servers) = _withDeadline(_afsLocateTimeout,
+                                                afs.fs.whereis, self.path)
+        except OSError as e:
+            logger.debug("Error finding file servers for %s: %s",
+                         self.path, e)
+            return
+        if finished:
+            _afsHealth.learn(self.path, servers)
+
     def getZephyrTriplets(self):
         rv = []
         try:
-            cell = afs.fs.whichcell(self.path)
+            cell = self._afs('whichcell', afs.fs.whichcell, self.path)
             rv.append(('filsrv', cell+':root.cell', '*'))
             rv.append(('filsrv', cell, '*'))
             try:
-                volume = afs.fs.examine(self.path)[0].name
+                volume = self._afs('examine', afs.fs.examine,
+                                   self.path)[0].name
                 rv.append(('filsrv', cell+':'+volume, '*'))
                 # Because dirname is stupid if it ends in a trailing slash
                 parent_dir = os.path.dirname(os.path.normpath(self.path))
-                parent_vol = afs.fs.examine(parent_dir)[0].name
+                parent_vol = self._afs('examine', afs.fs.examine,
+                                       parent_dir)[0].name
                 # TODO: This is a hack until afs.vos exists.  Once it
                 #       does, we should check if ParentId != Vid in
                 #       the VolumeStatus, and get the ParentId's name
                 if parent_vol.endswith('.readonly'):
                     parent_vol = parent_vol[0:len(parent_vol)-9]
                 rv.append(('filsrv', cell+':'+parent_vol, '*'))
-            except:
-                pass
-        except:
-            pass
-        for f in self.getFileServers():
-            rv.append(('filsrv', f.lower(), '*'))
+            except (OSError, LockerError) as e:
+                logger.debug("Error examining %s: %s", self.path, e)
+        except (OSError, LockerError) as e:
+            logger.debug("Error finding cell for %s: %s", self.path, e)
+        try:
+            for f in self.getFileServers():
+                rv.append(('filsrv', f.lower(), '*'))
+        except LockerError as e:
+            logger.debug("Error finding file servers for %s: %s",
+                         self.path, e)
         return rv
 
     def getQuota(self):
         try:
-            volstat = afs.fs.examine(self.path)[0]
-            return LockerQuota(volstat.BlocksInUse, volstat.MaxQuota)
+            volstat = self._afs('examine', afs.fs.examine, self.path)[0]
         except OSError as e:
             raise LockerError("Error getting AFS quota: %s: %s" % (self.path,
                               e.strerror))
+        return LockerQuota(volstat.BlocksInUse, volstat.MaxQuota)
 
     def getFileServers(self):
         try:
-            return afs.fs.whereis(self.path)
-        except:
+            servers = self._afs('whereis', afs.fs.whereis, self.path)
+        except LockerUnavailableError as e:
+            # A dead file server still serves the locker as far as
+            # callers like "detach -H" are concerned, so fall back to
+            # what we last learned, if anything.
+            servers = _afsHealth.serversFor(self.path)
+            if len(servers) == 0:
+                raise
+            logger.debug("%s", e)
+            return servers
+        except OSError as e:
+            logger.debug("Error finding file servers for %s: %s",
+                         self.path, e)
             return []
+        return servers
 
 class NFSLocker(Locker):
     """
@@ -358,6 +709,291 @@ def fromSymlink(src, dst, mountpoint):
     path = os.path.join(mountpoint, dst)
     return LOCLocker(dst, "%s n %s" % (src, path))
 
+def _text(b):
+    """
+    Return bytes read from an index as a native string.
+    """
+    return b if isinstance(b, str) else b.decode('utf-8')
+
+def _parseFilsys(records):
+    """
+    Turn the raw filsys records for a name into the same list of
+    dictionaries hesiod.FilsysLookup(parseFilsysTypes=False) returns.
+    A priority is only parsed (as the last field) when there is more
+    than one record, and the list is sorted on it.
+    """
+    filsys = []
+    multiRecords = len(records) > 1
+    for r in records:
+        priority = 0
+        if multiRecords:
+            r, priority = r.rsplit(" ", 1)
+            priority = int(priority)
+        parts = r.split(" ")
+        filsys.append({'type': parts[0],
+                       'data': ' '.join(parts[1:]),
+                       'priority': priority})
+    filsys.sort(key=lambda x: x['priority'])
+    return filsys
+
+class HesiodResolver(object):
+    """
+    Resolve lockers with a live Hesiod lookup.
+    """
+    def resolve(self, name):
+        try:
+            return hesiod.FilsysLookup(name, parseFilsysTypes=False).filsys
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise LockerNotFoundError(name)
+            else:
+                raise LockerError("Hesiod Error: %s while resolving %s" % \
+                                  (e.strerror if e.strerror else e.message, name))
+
+class FilsysIndexResolver(object):
+    """
+    Resolve lockers from a local dump of the Hesiod filsys map, for
+    machines which cannot reach Hesiod.  The dump has one record per
+    line, preceded by the locker name, e.g.
+
+      consult AFS /afs/athena.mit.edu/astaff/project/consult w /mit/consult
+
+    and lockers with several records (FSGROUPs) have one line per
+    record.  Blank lines and lines starting with '#' are ignored.
+
+    The dump is compiled into an index (by default, the dump's path
+    with '.index' appended) which is memory-mapped and binary searched
+    in place, so opening it does not depend on the size of the map.
+    If the index cannot be written there (e.g. the dump is in a
+    directory we cannot write to), it goes in the user's cache
+    directory instead, or failing that, is kept in memory.
+
+    The index is rebuilt whenever the dump's modification time or size
+    differs from those of the dump it was built from; call refresh()
+    after replacing the dump to pick up the new one.
+    """
+    _magic = b'FSIX'
+    # magic, entry count, dump mtime, dump size
+    _header = struct.Struct('!4sIdQ')
+    # key offset, key length, value offset, value length
+    _entry = struct.Struct('!IIII')
+
+    def __init__(self, dump, index=None):
+        self.dump = dump
+        self.index = index if index is not None else dump + '.index'
+        cache = os.getenv("XDG_CACHE_HOME",
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+        self._indexes = [self.index,
+                         os.path.join(cache, 'locker',
+                                      os.path.abspath(dump).replace('/', '%') +
+                                      '.index')]
+        self._lock = threading.Lock()
+        self._refreshLock = threading.Lock()
+        self._map = None
+        self._count = 0
+        self._stamp = None
+        self.refresh()
+
+    def _dumpStamp(self):
+        try:
+            st = os.stat(self.dump)
+        except OSError as e:
+            raise LockerError("Failed to read filsys dump: %s" % (e,))
+        return (st.st_mtime, st.st_size)
+
+    def _build(self, stamp):
+        """
+        Compile the dump, and return the contents of the index.
+        """
+        logger.debug("Building filsys index from %s", self.dump)
+        records = {}
+        try:
+            with open(self.dump, 'rb') as f:
+                for line in f:
+                    line = line.strip()
+                    if len(line) == 0 or line.startswith(b'#'):
+                        continue
+                    parts = line.split(None, 1)
+                    if len(parts) != 2:
+                        raise LockerError("Invalid filsys dump line: %s" % \
+                                          (_text(line),))
+                    records.setdefault(parts[0].lower(), []).append(parts[1])
+        except IOError as e:
+            raise LockerError("Failed to read filsys dump: %s" % (e,))
+        keys = sorted(records.keys())
+        offset = self._header.size + len(keys) * self._entry.size
+        entries = []
+        blob = []
+        for k in keys:
+            v = b'\n'.join(records[k])
+            entries.append(self._entry.pack(offset, len(k),
+                                            offset + len(k), len(v)))
+            blob.append(k + v)
+            offset += len(k) + len(v)
+        return self._header.pack(self._magic, len(keys),
+                                 stamp[0], stamp[1]) + \
+            b''.join(entries) + b''.join(blob)
+
+    def _write(self, data, index):
+        """
+        Atomically write an index, returning True on success.
+        """
+        try:
+            directory = os.path.dirname(os.path.abspath(index))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            (fd, tmp) = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, index)
+        except (IOError, OSError) as e:
+            logger.debug("Unable to write filsys index %s: %s", index, e)
+            return False
+        return True
+
+    def _parse(self, m):
+        """
+        Return (map, entry count, dump stamp) for the contents of an
+        index, or None if it is not one.
+        """
+        if len(m) < self._header.size:
+            return None
+        (magic, count, mtime, size) = \
+            self._header.unpack(m[0:self._header.size])
+        if magic != self._magic:
+            return None
+        return (m, count, (mtime, size))
+
+    def _open(self, index):
+        """
+        Map an index, returning what _parse() does, or None if it is
+        missing or not an index.
+        """
+        try:
+            with open(index, 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError) as e:
+            logger.debug("Unable to map filsys index %s: %s", index, e)
+            return None
+        rv = self._parse(m)
+        if rv is None:
+            m.close()
+        return rv
+
+    def refresh(self):
+        """
+        Rebuild the index if the dump has changed since it was built,
+        and start using it.  Rebuilding rereads the whole dump, which
+        costs more than writing out the whole index, so there is
+        nothing to gain by patching the old index in place.
+        """
+        with self._refreshLock:
+            self._refresh()
+
+    def _refresh(self):
+        stamp = self._dumpStamp()
+        with self._lock:
+            if self._stamp == stamp:
+                return
+        # Only an index built from exactly this dump will do: a dump
+        # copied with its old mtime kept (cp -p, rsync -t) is still a
+        # different dump.
+        opened = None
+        for index in self._indexes:
+            opened = self._open(index)
+            if opened is None:
+                continue
+            if opened[2] == stamp:
+                break
+            opened[0].close()
+            opened = None
+        if opened is None:
+            data = self._build(stamp)
+            for index in self._indexes:
+                if self._write(data, index):
+                    opened = self._open(index)
+                    if opened is not None:
+                        break
+        if opened is None:
+            logger.debug("Keeping filsys index for %s in memory", self.dump)
+            opened = self._parse(data)
+        # The old map is not closed explicitly: lookups in progress may
+        # still be using it, and it is unmapped once they are done.
+        with self._lock:
+            (self._map, self._count, self._stamp) = opened
+
+    def _find(self, key):
+        with self._lock:
+            m = self._map
+            count = self._count
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self._header.size + mid * self._entry.size
+            (koff, klen, voff, vlen) = \
+                self._entry.unpack(m[start:start + self._entry.size])
+            k = m[koff:koff + klen]
+            if k < key:
+                lo = mid + 1
+            elif k > key:
+                hi = mid
+            else:
+                return _text(m[voff:voff + vlen]).split('\n')
+        return None
+
+    def resolve(self, name):
+        records = self._find(name.lower().encode('utf-8'))
+        if records is None:
+            raise LockerNotFoundError(name)
+        try:
+            return _parseFilsys(records)
+        except ValueError:
+            raise LockerError("Invalid filsys record for %s in %s" % \
+                              (name, self.dump))
+
+_resolver = None
+# Why the default resolver could not be set up, if it could not
+_resolverError = None
+_resolverLock = threading.Lock()
+
+def getResolver():
+    """
+    Return the backend used by resolve() and lookup().  Unless one
+    has been set with setResolver(), this is a FilsysIndexResolver if
+    LOCKER_FILSYS_DUMP names a filsys dump, and Hesiod otherwise.
+
+    Raises: LockerError if the filsys dump cannot be loaded.  The
+    failure is remembered until setResolver() is called.
+    """
+    global _resolver, _resolverError
+    with _resolverLock:
+        if _resolverError is not None:
+            raise _resolverError
+        if _resolver is None:
+            dump = os.getenv("LOCKER_FILSYS_DUMP")
+            if dump:
+                try:
+                    _resolver = FilsysIndexResolver(dump)
+                except LockerError as e:
+                    _resolverError = LockerError(
+                        "Unable to use LOCKER_FILSYS_DUMP (%s): %s" % \
+                        (dump, e.message))
+                    raise _resolverError
+            else:
+                _resolver = HesiodResolver()
+        return _resolver
+
+def setResolver(resolver):
+    """
+    Use resolver (any object with a resolve(name) method returning a
+    list of filsys dictionaries) for resolve() and lookup().
+    """
+    global _resolver, _resolverError
+    with _resolverLock:
+        _resolver = resolver
+        _resolverError = None
+
 def lookup(name):
     """
     Lookup a locker in Hesiod and return a list locker objects.  For
@@ -378,26 +1014,18 @@ def lookup(name):
 
 def resolve(name):
     """
-    Lookup a locker in Hesiod and return a list of dictionaries, with
-    keys 'priority', 'data', and 'type'.   If the lookup found an FSGROUP,
-    the list will be sorted based on key the key 'priority'.
+    Lookup a locker in Hesiod (or the backend set with setResolver())
+    and return a list of dictionaries, with keys 'priority', 'data',
+    and 'type'.   If the lookup found an FSGROUP, the list will be
+    sorted based on key the key 'priority'.
 
     Raises: LockerNotFoundError, LockerError
     """
-    filesystems = []
     # Avoid generating a confusing "message too long" error from
     # Hesiod.
     if name.startswith('.'):
         raise LockerError("Invalid locker name: " + name)
-    try:
-        filesystems = hesiod.FilsysLookup(name, parseFilsysTypes=False).filsys
-    except IOError as e:
-        if e.errno == errno.ENOENT:
-            raise LockerNotFoundError(name)
-        else:
-            raise LockerError("Hesiod Error: %s while resolving %s" % \
-                              (e.strerror if e.strerror else e.message, name))
-    return filesystems
+    return getResolver().resolve(name)
 
 def ellipsize(text, maxlen):
     if len(text) <= maxlen:
@@ -405,6 +1033,160 @@ def ellipsize(text, maxlen):
     cutoff = (maxlen - 5) / 2
     return text[:int(math.ceil(cutoff))] + '[...]' + text[-int(math.floor(cutoff)):]
 
+class HostCache(object):
+    """
+    Cache forward and reverse host lookups (including failed ones)
+    for ttl seconds.
+    """
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._forward = {}
+        self._reverse = {}
+
+    def _cached(self, cache, func, key):
+        now = time.time()
+        with self._lock:
+            if key in cache and now - cache[key][0] < self.ttl:
+                (when, result, error) = cache[key]
+                if error is not None:
+                    raise error
+                return result
+        try:
+            result = func(key)
+            error = None
+        except socket.error as e:
+            result = None
+            error = e
+        with self._lock:
+            cache[key] = (now, result, error)
+        if error is not None:
+            raise error
+        return result
+
+    def lookup(self, host):
+        """
+        Return socket.gethostbyname_ex(host), cached.
+        """
+        return self._cached(self._forward, socket.gethostbyname_ex,
+                            host.lower())
+
+    def reverse(self, address):
+        """
+        Return socket.gethostbyaddr(address), cached.
+        """
+        return self._cached(self._reverse, socket.gethostbyaddr, address)
+
+    def identities(self, host, strict=False):
+        """
+        Return the set of (lowercase) names and addresses by which
+        host is known.  If strict is True, raise LockerError if host
+        cannot be looked up; otherwise, just return host itself.
+        """
+        rv = set([host.lower()])
+        try:
+            (name, aliases, addresses) = self.lookup(host)
+        except socket.error as e:
+            if strict:
+                raise LockerError("Cannot lookup host '%s'" % (host,))
+            logger.debug("Cannot lookup host %s: %s", host, e)
+            return rv
+        rv.add(name.lower())
+        rv.update([a.lower() for a in aliases])
+        rv.update(addresses)
+        # An address has no name until we ask for one
+        if host in addresses:
+            try:
+                (name, aliases, addresses) = self.reverse(host)
+                rv.add(name.lower())
+                rv.update([a.lower() for a in aliases])
+            except socket.error as e:
+                logger.debug("Cannot reverse lookup %s: %s", host, e)
+        return rv
+
+_hostCache = HostCache()
+
+class FileServerIndex(object):
+    """
+    An index of file servers to the lockers they serve, built by asking
+    each locker for its file servers concurrently.  lockers is a dict
+    (e.g. an attachtab) of Locker objects; lockersOn() returns its keys.
+    Lockers whose file servers could not be determined are listed,
+    with the error, in unknown.
+    """
+    def __init__(self, lockers=None, workers=8, hostCache=None):
+        self.workers = workers
+        self.hostCache = hostCache if hostCache is not None else _hostCache
+        # lowercase server -> list of keys
+        self._servers = {}
+        # key -> LockerError, for lockers whose servers are unknown
+        self.unknown = {}
+        if lockers is None:
+            return
+        keys = list(lockers.keys())
+        results = _concurrently(lambda k: lockers[k].getFileServers(),
+                                keys, workers)
+        for (k, (servers, error)) in zip(keys, results):
+            self.add(k, servers, error)
+
+    def add(self, key, servers, error=None):
+        """
+        Add the result of a locker's getFileServers() to the index:
+        either its list of servers, or the exception it raised.
+        Exceptions other than LockerErrors are re-raised.
+        """
+        if isinstance(error, LockerNotSupportedError):
+            return
+        if isinstance(error, LockerError):
+            logger.debug("Skipping %s: %s", key, error)
+            self.unknown[key] = error
+            return
+        if error is not None:
+            raise error
+        for server in servers:
+            self._servers.setdefault(server.lower(), []).append(key)
+
+    def servers(self):
+        """
+        Return the (lowercase) names of all file servers in the index.
+        """
+        return sorted(self._servers.keys())
+
+    def lockersOn(self, host):
+        """
+        Return the set of keys of the lockers served by host, which may be
+        any name or address the server is known by.  The file servers
+        themselves are only looked up if none of them matches one of
+        host's names or addresses outright.
+
+        Raises: LockerError if host cannot be looked up.
+        """
+        wanted = self.hostCache.identities(host, strict=True)
+        servers = self.matching(wanted)
+        if len(servers) == 0:
+            others = self.servers()
+            results = _concurrently(self.hostCache.identities, others,
+                                    self.workers)
+            servers = [s for (s, (ids, error)) in zip(others, results)
+                       if len(wanted.intersection(ids)) > 0]
+        return self.lockersFor(servers)
+
+    def matching(self, identities):
+        """
+        Return the servers in the index whose name is one of
+        identities (as returned by HostCache.identities()).
+        """
+        return [s for s in self.servers() if s in identities]
+
+    def lockersFor(self, servers):
+        """
+        Return the set of keys of the lockers served by any of servers.
+        """
+        rv = set()
+        for s in servers:
+            rv.update(self._servers.get(s, []))
+        return rv
+
 class attachtab(dict):
     """
     A magic dictionary with magic versions of __getitem__ and __contains__
@@ -432,6 +1214,13 @@ class attachtab(dict):
                     return True
             return False
 
+    def fileServerIndex(self, workers=8):
+        """
+        Return a FileServerIndex of the attached lockers, keyed by
+        mountpoint.
+        """
+        return FileServerIndex(self, workers)
+
     def _legacyFormat(self):
         fmt = "%-30s %-26s %-9s %s\n"
         rv = fmt % ("filesystem", "mountpoint", "user", "mode")
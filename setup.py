@@ -1,9 +1,15 @@
+import sys
 from distutils.core import setup
 
+py_modules = ['locker', 'athdir']
+# The asyncio API needs a newer Python than the rest of the package.
+if sys.version_info >= (3, 7):
+    py_modules.append('aiolocker')
+
 setup(name='locker-support',
       version='10.4.7',
       author='Debathena Project',
       author_email='debathena@mit.edu',
-      py_modules=['locker', 'athdir'],
+      py_modules=py_modules,
       scripts=['attach', 'detach', 'fsid', 'quota.debathena', 'athdir'],
       )
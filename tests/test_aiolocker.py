@@ -0,0 +1,318 @@
+"""
+Tests for aiolocker, run against stand-in Hesiod and AFS backends and
+fake machtype and aklog executables.  (Requires Python 3.7 or later.)
+"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# locker imports afs.fs and hesiod, which we replace with stand-ins.
+_afs = types.ModuleType('afs')
+_afs.fs = types.ModuleType('afs.fs')
+sys.modules['afs'] = _afs
+sys.modules['afs.fs'] = _afs.fs
+sys.modules['hesiod'] = types.ModuleType('hesiod')
+
+import aiolocker
+import athdir
+import locker
+
+class Concurrency(object):
+    """
+    Count how many calls are in flight at once.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def __enter__(self):
+        with self._lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+
+    def __exit__(self, *exc):
+        with self._lock:
+            self.current -= 1
+
+class StubResolver(object):
+    """
+    A resolver which takes a while to answer, and knows every locker
+    except those named 'missing*'.
+    """
+    def __init__(self, delay):
+        self.delay = delay
+        self.concurrency = Concurrency()
+
+    def resolve(self, name):
+        with self.concurrency:
+            time.sleep(self.delay)
+        if name.startswith('missing'):
+            raise locker.LockerNotFoundError(name)
+        return [{'type': 'AFS', 'priority': 0,
+                 'data': '/afs/test/%s w /mit/%s' % (name, name)}]
+
+class VolumeStatus(object):
+    name = 'user.test'
+    BlocksInUse = 50
+    MaxQuota = 100
+
+def serverNumber(path):
+    """
+    Spread paths across three file servers.
+    """
+    return sum(ord(c) for c in path) % 3
+
+class StubAFS(object):
+    """
+    Slow stand-ins for afs.fs.examine and afs.fs.whereis.  Paths
+    ending in 'broken' raise OSError.
+    """
+    def __init__(self, delay):
+        self.delay = delay
+        self.concurrency = Concurrency()
+
+    def _call(self, path):
+        with self.concurrency:
+            time.sleep(self.delay)
+        if path.endswith('broken'):
+            raise OSError(5, 'Input/output error')
+
+    def examine(self, path):
+        self._call(path)
+        return [VolumeStatus()]
+
+    def whereis(self, path):
+        self._call(path)
+        return ['FS%d.TEST' % (serverNumber(path),)]
+
+    def whichcell(self, path):
+        self._call(path)
+        return 'test'
+
+class StubHostCache(locker.HostCache):
+    """
+    A host cache which knows every fsN.test host (at 10.0.0.N), and
+    nothing else.
+    """
+    def lookup(self, host):
+        host = host.lower()
+        # Like gethostbyname_ex(), addresses resolve to themselves
+        if host.startswith('10.0.0.'):
+            return (host, [], [host])
+        if not host.startswith('fs') or not host.endswith('.test'):
+            raise locker.socket.gaierror(-2, 'Name or service not known')
+        return (host, [], ['10.0.0.%s' % (host[2:-5],)])
+
+    def reverse(self, address):
+        return ('fs%s.test' % (address.split('.')[-1],), [], [address])
+
+def afsLocker(name):
+    return locker.AFSLocker(name, '/afs/test/%s w /mit/%s' % (name, name))
+
+_machtype = """#!/bin/sh
+case "$1" in
+  -S) echo amd64_test2 ;;
+  -C) echo amd64_test1:i386_test1 ;;
+  *) echo linux ;;
+esac
+"""
+
+# Fails for any path ending in 'bad', and hangs for any ending in 'hang'
+# (after recording its PID in $AKLOG_PIDFILE).
+_aklog = """#!/bin/sh
+case "$2" in
+  *bad) exit 1 ;;
+  *hang) echo $$ > "$AKLOG_PIDFILE"; exec sleep 30 ;;
+esac
+sleep 0.2
+"""
+
+class AiolockerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for (name, script) in (('machtype', _machtype), ('aklog', _aklog)):
+            path = os.path.join(self.tmpdir, name)
+            with open(path, 'w') as f:
+                f.write(script)
+            os.chmod(path, 0o755)
+        self.environ = dict(os.environ)
+        os.environ['PATH'] = self.tmpdir + ':' + os.environ.get('PATH', '')
+        os.environ['AKLOG_PIDFILE'] = os.path.join(self.tmpdir, 'aklog.pid')
+        for var in ('ATHENA_SYS', 'ATHENA_SYS_COMPAT', 'HOSTTYPE'):
+            os.environ.pop(var, None)
+        self.afs = StubAFS(0.05)
+        self.saved = dict((f, getattr(locker.afs.fs, f, None))
+                          for f in ('examine', 'whereis', 'whichcell'))
+        for f in self.saved:
+            setattr(locker.afs.fs, f, getattr(self.afs, f))
+        locker.configureAFS(timeout=5)
+        self.resolver = StubResolver(0.05)
+        locker.setResolver(self.resolver)
+        self.runner = aiolocker.Runner(workers=10, subprocesses=3)
+
+    def tearDown(self):
+        self.runner.shutdown()
+        locker.setResolver(None)
+        for (f, func) in self.saved.items():
+            setattr(locker.afs.fs, f, func)
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmpdir)
+
+    def run_async(self, coro):
+        return asyncio.run(coro)
+
+    def test_lookup_fanout(self):
+        names = ['locker%d' % i for i in range(200)]
+        ticks = []
+        async def main():
+            async def ticker():
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks.append(1)
+            t = asyncio.ensure_future(ticker())
+            start = time.time()
+            rv = await asyncio.gather(*[aiolocker.lookup(n, self.runner)
+                                        for n in names])
+            elapsed = time.time() - start
+            t.cancel()
+            return (rv, elapsed)
+        (results, elapsed) = self.run_async(main())
+        self.assertEqual([r[0].name for r in results], names)
+        self.assertEqual(results[7][0].path, '/afs/test/locker7')
+        self.assertEqual(self.resolver.concurrency.peak, 10)
+        # 200 lookups of 0.05s, 10 at a time
+        self.assertLess(elapsed, 200 * 0.05 / 2)
+        # The event loop kept running while the lookups were blocked
+        self.assertGreater(len(ticks), elapsed / 0.01 / 4)
+
+    def test_lookup_errors(self):
+        names = ['locker1', 'missing1', 'locker2', '.invalid']
+        async def main():
+            return await asyncio.gather(*[aiolocker.lookup(n, self.runner)
+                                          for n in names],
+                                        return_exceptions=True)
+        results = self.run_async(main())
+        self.assertEqual(results[0][0].name, 'locker1')
+        self.assertIsInstance(results[1], locker.LockerNotFoundError)
+        self.assertEqual(results[2][0].name, 'locker2')
+        self.assertIsInstance(results[3], locker.LockerError)
+
+    def test_resolve(self):
+        rv = self.run_async(aiolocker.resolve('consult', self.runner))
+        self.assertEqual(rv, self.resolver.resolve('consult'))
+
+    def test_quota_fanout(self):
+        lockers = [afsLocker('locker%d' % i) for i in range(100)]
+        lockers.append(afsLocker('broken'))
+        async def main():
+            return await asyncio.gather(*[aiolocker.getQuota(l, self.runner)
+                                          for l in lockers],
+                                        return_exceptions=True)
+        results = self.run_async(main())
+        self.assertEqual(results[0].percentage(), 50)
+        self.assertIsInstance(results[-1], locker.LockerError)
+        self.assertLessEqual(self.afs.concurrency.peak, 10)
+
+    def test_file_server_index(self):
+        lockers = dict(('/mit/locker%d' % i, afsLocker('locker%d' % i))
+                       for i in range(50))
+        lockers['/mit/loc'] = locker.LOCLocker('loc', '/tmp n /mit/loc')
+        async def main():
+            index = await aiolocker.fileServerIndex(lockers, self.runner)
+            index.hostCache = StubHostCache()
+            return (index,
+                    await aiolocker.lockersOn(index, '10.0.0.1', self.runner),
+                    await aiolocker.lockersOn(index, 'FS1.test', self.runner))
+        (index, on, byName) = self.run_async(main())
+        self.assertEqual(on, byName)
+        self.assertEqual(index.servers(), ['fs0.test', 'fs1.test', 'fs2.test'])
+        self.assertEqual(sorted(on),
+                         sorted(k for k in lockers
+                                if k != '/mit/loc' and
+                                serverNumber(lockers[k].path) == 1))
+        self.assertEqual(index.unknown, {})
+        self.assertLessEqual(self.afs.concurrency.peak, 10)
+        with self.assertRaises(locker.LockerError):
+            self.run_async(aiolocker.lockersOn(index, 'elsewhere.test',
+                                               self.runner))
+
+    def test_authenticate_fanout(self):
+        lockers = [afsLocker('locker%d' % i) for i in range(9)]
+        async def main():
+            start = time.time()
+            await asyncio.gather(*[aiolocker.authenticate(l, self.runner)
+                                   for l in lockers])
+            return time.time() - start
+        elapsed = self.run_async(main())
+        # 9 aklogs of 0.2s, 3 at a time
+        self.assertGreaterEqual(elapsed, 3 * 0.2)
+        self.assertLess(elapsed, 9 * 0.2)
+
+    def test_authenticate_errors(self):
+        with self.assertRaises(locker.NamedLockerError):
+            self.run_async(aiolocker.authenticate(afsLocker('bad'),
+                                                  self.runner))
+        os.environ['PATH'] = os.path.join(self.tmpdir, 'nonexistent')
+        with self.assertRaises(locker.NamedLockerError):
+            self.run_async(aiolocker.authenticate(afsLocker('locker1'),
+                                                  self.runner))
+        # Lockers without an authentication command are a no-op
+        self.run_async(aiolocker.authenticate(
+            locker.LOCLocker('loc', '/tmp n /mit/loc'), self.runner))
+
+    def test_cancel_kills_subprocess(self):
+        pidfile = os.environ['AKLOG_PIDFILE']
+        async def main():
+            try:
+                await asyncio.wait_for(
+                    aiolocker.authenticate(afsLocker('hang'), self.runner),
+                    timeout=1)
+            except asyncio.TimeoutError:
+                pass
+        self.run_async(main())
+        with open(pidfile) as f:
+            pid = int(f.read())
+        with self.assertRaises(OSError):
+            os.kill(pid, 0)
+
+    def test_athdir(self):
+        async def main():
+            adir = await aiolocker.makeAthdir('/mit/test', 'bin',
+                                              runner=self.runner)
+            return (adir, await aiolocker.get_paths(adir, self.runner,
+                                                    listAll=True))
+        (adir, paths) = self.run_async(main())
+        self.assertEqual(adir.compatlist,
+                         ['amd64_test2', 'amd64_test1', 'i386_test1'])
+        self.assertEqual(adir.hostType, 'linux')
+        self.assertEqual(paths[0], '/mit/test/arch/amd64_test2/bin')
+
+    def test_athdir_fanout(self):
+        async def main():
+            return await asyncio.gather(*[aiolocker.makeAthdir(
+                '/mit/locker%d' % i, 'bin', runner=self.runner)
+                                          for i in range(20)])
+        adirs = self.run_async(main())
+        self.assertEqual([a.path for a in adirs],
+                         ['/mit/locker%d' % i for i in range(20)])
+
+    def test_athdir_without_machtype(self):
+        os.environ['PATH'] = os.path.join(self.tmpdir, 'nonexistent')
+        if os.path.exists('/bin/machtype'):
+            self.skipTest("/bin/machtype exists")
+        with self.assertRaises(athdir.AthdirInternalError):
+            self.run_async(aiolocker.makeAthdir('/mit/test', 'bin',
+                                                runner=self.runner))
+
+if __name__ == '__main__':
+    unittest.main()
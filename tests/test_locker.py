@@ -0,0 +1,626 @@
+"""
+Tests for locker, run against stand-in Hesiod and AFS backends.
+"""
+import errno
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import types
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# locker imports afs.fs and hesiod, which we replace with stand-ins.
+_afs = types.ModuleType('afs')
+_afs.fs = types.ModuleType('afs.fs')
+sys.modules['afs'] = _afs
+sys.modules['afs.fs'] = _afs.fs
+sys.modules['hesiod'] = types.ModuleType('hesiod')
+
+import locker
+
+def waitFor(condition, timeout=2):
+    """
+    Poll until condition() is true, or timeout seconds pass.
+    """
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+class VolumeStatus(object):
+    name = 'user.test'
+    BlocksInUse = 50
+    MaxQuota = 100
+
+class StubAFS(object):
+    """
+    Stand-ins for afs.fs.examine, afs.fs.whereis and afs.fs.whichcell.
+    Each path is served by the servers in self.servers (by default,
+    FS1.TEST), and calls on a path served by a server in self.hung
+    hang until it is removed from there.
+    """
+    def __init__(self):
+        self.servers = {}
+        self.hung = set()
+        self.calls = 0
+
+    def _call(self, path):
+        self.calls += 1
+        while len(self.hung.intersection(self.whereis(path, False))) > 0:
+            time.sleep(0.01)
+
+    def examine(self, path):
+        self._call(path)
+        return [VolumeStatus()]
+
+    def whereis(self, path, call=True):
+        if call:
+            self.calls += 1
+        return self.servers.get(path, ['FS1.TEST'])
+
+    def whichcell(self, path):
+        self._call(path)
+        return 'test'
+
+def afsLocker(name):
+    return locker.AFSLocker(name, '/afs/test/%s w /mit/%s' % (name, name))
+
+class StubDNS(object):
+    """
+    Stand-ins for socket.gethostbyname_ex and socket.gethostbyaddr,
+    which know the hosts in self.hosts, and count how often they are
+    asked about each one.
+    """
+    hosts = {
+        'fs1.test': ('fs1.test', ['afsdb1.test'], ['10.0.0.1']),
+        'fs2.test': ('fs2.test', [], ['10.0.0.2']),
+        'fs1.internal.test': ('fs1.internal.test', [], ['10.0.0.1']),
+        'fs2.internal.test': ('fs2.internal.test', [], ['10.0.0.2']),
+    }
+
+    def __init__(self):
+        self.forward = {}
+        self.reverse = {}
+
+    def gethostbyname_ex(self, host):
+        self.forward[host] = self.forward.get(host, 0) + 1
+        if host.startswith('10.0.0.'):
+            return (host, [], [host])
+        for (name, aliases, addresses) in self.hosts.values():
+            if host == name or host in aliases:
+                return (name, aliases, addresses)
+        raise socket.gaierror(-2, 'Name or service not known')
+
+    def gethostbyaddr(self, address):
+        self.reverse[address] = self.reverse.get(address, 0) + 1
+        if address not in ('10.0.0.1', '10.0.0.2'):
+            raise socket.herror(1, 'Unknown host')
+        return self.hosts['fs%s.test' % (address[-1],)]
+
+class BrokenLocker(object):
+    """
+    A locker whose file servers cannot be determined.
+    """
+    def __init__(self, error):
+        self.error = error
+
+    def getFileServers(self):
+        raise self.error
+
+class StubFilsysLookup(object):
+    """
+    A stand-in for hesiod.FilsysLookup(name, parseFilsysTypes=False),
+    parsing the records in self.records the way python-hesiod does.
+    """
+    records = {}
+
+    def __init__(self, name, parseFilsysTypes=True):
+        if name.lower() not in self.records:
+            raise IOError(errno.ENOENT, 'No such file or directory')
+        self.results = self.records[name.lower()]
+        self.filsys = []
+        self.multiRecords = (len(self.results) > 1)
+        for result in self.results:
+            priority = 0
+            if self.multiRecords:
+                result, priority = result.rsplit(" ", 1)
+                priority = int(priority)
+            parts = result.split(" ")
+            self.filsys.append(dict(type=parts[0],
+                                    data=' '.join(parts[1:]),
+                                    priority=priority))
+        self.filsys.sort(key=(lambda x: x['priority']))
+
+class LockerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.afs = StubAFS()
+        self.saved = dict((f, getattr(locker.afs.fs, f, None))
+                          for f in ('examine', 'whereis', 'whichcell'))
+        for f in self.saved:
+            setattr(locker.afs.fs, f, getattr(self.afs, f))
+        self.environ = dict(os.environ)
+
+    def tearDown(self):
+        # Let abandoned calls finish
+        self.afs.hung.clear()
+        locker.configureAFS()
+        locker.setResolver(None)
+        for (f, func) in self.saved.items():
+            setattr(locker.afs.fs, f, func)
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmpdir)
+
+class DeadlineTestCase(LockerTestCase):
+    def test_finished(self):
+        self.assertEqual(locker._withDeadline(1, lambda x: x * 2, 21),
+                         (True, 42))
+        self.assertEqual(locker._withDeadline(None, lambda: 'done'),
+                         (True, 'done'))
+
+    def test_missed(self):
+        start = time.time()
+        self.assertEqual(locker._withDeadline(0.1, time.sleep, 2),
+                         (False, None))
+        self.assertLess(time.time() - start, 1)
+
+    def test_exception(self):
+        def fail():
+            raise OSError(5, 'Input/output error')
+        with self.assertRaises(OSError):
+            locker._withDeadline(1, fail)
+
+class FileServerHealthTestCase(LockerTestCase):
+    def test_single_server(self):
+        health = locker.FileServerHealth()
+        health.learn('/afs/test/a', ['FS1.TEST'])
+        self.assertFalse(health.anyDown())
+        health.failed('/afs/test/a')
+        self.assertTrue(health.anyDown())
+        self.assertTrue(health.isDown('/afs/test/a'))
+        # Unknown paths are never down
+        self.assertFalse(health.isDown('/afs/test/b'))
+
+    def test_replicated(self):
+        health = locker.FileServerHealth()
+        health.learn('/afs/test/a', ['FS1.TEST', 'FS2.TEST'])
+        # One timeout is shared out, and kills neither replica
+        health.failed('/afs/test/a')
+        self.assertFalse(health.anyDown())
+        health.failed('/afs/test/a')
+        self.assertTrue(health.isDown('/afs/test/a'))
+
+    def test_replica_seen_answering(self):
+        health = locker.FileServerHealth()
+        health.learn('/afs/test/a', ['FS1.TEST', 'FS2.TEST'])
+        health.learn('/afs/test/b', ['FS2.TEST'])
+        health.succeeded('/afs/test/b')
+        # FS2 just answered, so the timeout is all FS1's
+        health.failed('/afs/test/a')
+        self.assertFalse(health.isDown('/afs/test/a'))
+        health.learn('/afs/test/c', ['FS1.TEST'])
+        self.assertTrue(health.isDown('/afs/test/c'))
+        self.assertFalse(health.isDown('/afs/test/b'))
+
+    def test_strikes_expire(self):
+        health = locker.FileServerHealth(cooldown=0.1)
+        health.learn('/afs/test/a', ['FS1.TEST', 'FS2.TEST'])
+        health.failed('/afs/test/a')
+        time.sleep(0.15)
+        health.failed('/afs/test/a')
+        self.assertFalse(health.anyDown())
+
+    def test_probe_revives(self):
+        health = locker.FileServerHealth(cooldown=0.1)
+        health.learn('/afs/test/a', ['FS1.TEST'])
+        health.failed('/afs/test/a')
+        self.assertTrue(health.isDown('/afs/test/a'))
+        self.assertEqual(self.afs.calls, 0)
+        time.sleep(0.15)
+        # The probe runs in the background; we still fail fast
+        self.assertTrue(health.isDown('/afs/test/a'))
+        self.assertTrue(waitFor(lambda: not health.isDown('/afs/test/a')))
+        self.assertFalse(health.anyDown())
+
+    def test_probe_fails(self):
+        locker.configureAFS(timeout=0.1)
+        health = locker.FileServerHealth(cooldown=0.1)
+        health.learn('/afs/test/a', ['FS1.TEST'])
+        health.failed('/afs/test/a')
+        self.afs.hung.add('FS1.TEST')
+        time.sleep(0.15)
+        died = health._dead['FS1.TEST']
+        self.assertTrue(health.isDown('/afs/test/a'))
+        self.assertTrue(waitFor(lambda: len(health._probing) == 0))
+        # The failed probe starts a new cool-down
+        self.assertTrue(health.isDown('/afs/test/a'))
+        self.assertGreater(health._dead['FS1.TEST'], died)
+
+    def test_statefile(self):
+        statefile = os.path.join(self.tmpdir, 'state', 'afs-health.json')
+        health = locker.FileServerHealth(statefile=statefile)
+        health.learn('/afs/test/a', ['FS1.TEST'])
+        health.failed('/afs/test/a')
+        shared = locker.FileServerHealth(statefile=statefile)
+        self.assertEqual(shared.serversFor('/afs/test/a'), ['FS1.TEST'])
+        self.assertTrue(shared.isDown('/afs/test/a'))
+        # Old state is ignored
+        stale = locker.FileServerHealth(statefile=statefile, ttl=0)
+        self.assertEqual(stale.serversFor('/afs/test/a'), [])
+        self.assertFalse(stale.anyDown())
+
+    def test_statefile_concurrent(self):
+        statefile = os.path.join(self.tmpdir, 'afs-health.json')
+        health = locker.FileServerHealth(statefile=statefile)
+        paths = ['/afs/test/locker%d' % i for i in range(100)]
+        threads = [threading.Thread(target=health.learn,
+                                    args=(p, ['FS1.TEST']))
+                   for p in paths]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        with open(statefile) as f:
+            self.assertEqual(sorted(json.load(f)['servers'].keys()),
+                             sorted(paths))
+
+    def test_default_statefile(self):
+        os.environ.pop('LOCKER_AFS_STATE', None)
+        os.environ['XDG_CACHE_HOME'] = self.tmpdir
+        self.assertEqual(locker.defaultAFSStateFile(),
+                         os.path.join(self.tmpdir, 'locker',
+                                      'afs-health.json'))
+        os.environ['LOCKER_AFS_STATE'] = '/tmp/state.json'
+        self.assertEqual(locker.defaultAFSStateFile(), '/tmp/state.json')
+
+class AFSLockerTestCase(LockerTestCase):
+    def setUp(self):
+        LockerTestCase.setUp(self)
+        locker.configureAFS(timeout=0.2)
+
+    def test_timeout(self):
+        self.afs.hung.add('FS1.TEST')
+        a = afsLocker('a')
+        start = time.time()
+        with self.assertRaises(locker.LockerTimeoutError):
+            a.getQuota()
+        self.assertLess(time.time() - start, 1)
+        # The server was looked up to blame it for the timeout
+        self.assertTrue(locker._afsHealth.isDown(a.path))
+
+    def test_fail_fast(self):
+        self.afs.servers['/afs/test/c'] = ['FS2.TEST']
+        self.afs.hung.add('FS1.TEST')
+        with self.assertRaises(locker.LockerTimeoutError):
+            afsLocker('a').getQuota()
+        calls = self.afs.calls
+        start = time.time()
+        # Another locker on the same server is found to be on it,
+        # and not waited for
+        with self.assertRaises(locker.LockerUnavailableError) as cm:
+            afsLocker('b').getQuota()
+        self.assertFalse(isinstance(cm.exception, locker.LockerTimeoutError))
+        self.assertLess(time.time() - start, 0.2)
+        self.assertEqual(self.afs.calls, calls + 1)
+        # Lockers elsewhere are unaffected
+        self.assertEqual(afsLocker('c').getQuota().percentage(), 50)
+
+    def test_success_clears_strikes(self):
+        self.afs.servers['/afs/test/a'] = ['FS1.TEST', 'FS2.TEST']
+        self.afs.servers['/afs/test/b'] = ['FS2.TEST']
+        # FS2 answers a whereis, so a timeout on a replica is FS1's
+        self.assertEqual(afsLocker('b').getFileServers(), ['FS2.TEST'])
+        self.afs.hung.add('FS1.TEST')
+        self.afs.hung.add('FS2.TEST')
+        with self.assertRaises(locker.LockerTimeoutError):
+            afsLocker('a').getQuota()
+        self.assertFalse(locker._afsHealth.isDown('/afs/test/b'))
+        self.assertFalse(locker._afsHealth.isDown('/afs/test/a'))
+        locker._afsHealth.learn('/afs/test/c', ['FS1.TEST'])
+        self.assertTrue(locker._afsHealth.isDown('/afs/test/c'))
+
+    def test_file_servers_of_dead_locker(self):
+        a = afsLocker('a')
+        self.assertEqual(a.getFileServers(), ['FS1.TEST'])
+        self.afs.hung.add('FS1.TEST')
+        with self.assertRaises(locker.LockerTimeoutError):
+            a.getQuota()
+        # What we last learned is still the answer
+        self.assertEqual(a.getFileServers(), ['FS1.TEST'])
+
+    def test_file_servers_unknown(self):
+        # whereis itself hangs, so nothing can be learned
+        released = threading.Event()
+        locker.afs.fs.whereis = lambda path: released.wait()
+        try:
+            with self.assertRaises(locker.LockerUnavailableError):
+                afsLocker('a').getFileServers()
+        finally:
+            released.set()
+
+class FilsysIndexTestCase(LockerTestCase):
+    def setUp(self):
+        LockerTestCase.setUp(self)
+        os.environ['XDG_CACHE_HOME'] = os.path.join(self.tmpdir, 'cache')
+        self.dump = os.path.join(self.tmpdir, 'filsys.dump')
+        self.saved['FilsysLookup'] = getattr(locker.hesiod, 'FilsysLookup',
+                                             None)
+        locker.hesiod.FilsysLookup = StubFilsysLookup
+
+    def tearDown(self):
+        locker.hesiod.FilsysLookup = self.saved.pop('FilsysLookup')
+        StubFilsysLookup.records = {}
+        LockerTestCase.tearDown(self)
+
+    def writeDump(self, lines, mtime=None):
+        with open(self.dump, 'w') as f:
+            f.write(''.join(l + '\n' for l in lines))
+        if mtime is not None:
+            os.utime(self.dump, (mtime, mtime))
+        StubFilsysLookup.records = {}
+        for l in lines:
+            parts = l.split(None, 1)
+            if len(parts) != 2 or l.startswith('#'):
+                continue
+            StubFilsysLookup.records.setdefault(parts[0].lower(),
+                                                []).append(parts[1])
+
+    def assertMatchesHesiod(self, resolver, name):
+        try:
+            expected = locker.HesiodResolver().resolve(name)
+        except locker.LockerNotFoundError:
+            with self.assertRaises(locker.LockerNotFoundError):
+                resolver.resolve(name)
+            return
+        self.assertEqual(resolver.resolve(name), expected)
+
+    def test_lookup(self):
+        names = ['locker%d' % ((i * 7919) % 1000) for i in range(1000)]
+        self.writeDump(['# filsys dump', ''] +
+                       ['%s AFS /afs/test/%s w /mit/%s' % (n, n, n)
+                        for n in names])
+        resolver = locker.FilsysIndexResolver(self.dump)
+        self.assertTrue(os.path.exists(self.dump + '.index'))
+        for n in names + ['a', 'locker5000', 'zzz']:
+            self.assertMatchesHesiod(resolver, n)
+        self.assertEqual(resolver.resolve('locker42'),
+                         [{'type': 'AFS', 'priority': 0,
+                           'data': '/afs/test/locker42 w /mit/locker42'}])
+        with self.assertRaises(locker.LockerNotFoundError):
+            resolver.resolve('locker1000')
+
+    def test_case_insensitive(self):
+        self.writeDump(['Consult AFS /afs/test/consult w /mit/consult'])
+        resolver = locker.FilsysIndexResolver(self.dump)
+        for n in ('consult', 'CONSULT', 'Consult'):
+            self.assertMatchesHesiod(resolver, n)
+        self.assertEqual(resolver.resolve('CONSULT')[0]['data'],
+                         '/afs/test/consult w /mit/consult')
+
+    def test_fsgroup(self):
+        self.writeDump(['group NFS server:/export n /mit/group 3',
+                        'single AFS /afs/test/single w /mit/single 2',
+                        'group AFS /afs/test/group w /mit/group 1',
+                        'other AFS /afs/test/other w /mit/other',
+                        'group ERR Try again later 2'])
+        resolver = locker.FilsysIndexResolver(self.dump)
+        for n in ('group', 'single', 'other'):
+            self.assertMatchesHesiod(resolver, n)
+        self.assertEqual([(f['type'], f['priority'])
+                          for f in resolver.resolve('group')],
+                         [('AFS', 1), ('ERR', 2), ('NFS', 3)])
+        # A single record has no priority to parse
+        self.assertEqual(resolver.resolve('single')[0]['data'],
+                         '/afs/test/single w /mit/single 2')
+
+    def test_lookup_lockers(self):
+        self.writeDump(['gone ERR This locker has been deleted',
+                        'group ERR Try again later 2',
+                        'group AFS /afs/test/group w /mit/group 1',
+                        'weird UFS /dev/sda1 w /mit/weird'])
+        locker.setResolver(locker.FilsysIndexResolver(self.dump))
+        with self.assertRaises(locker.LockerUnavailableError) as cm:
+            locker.lookup('gone')
+        self.assertEqual(cm.exception.message,
+                         'This locker has been deleted')
+        # The ERR record is only reached after the AFS one
+        with self.assertRaises(locker.LockerUnavailableError):
+            locker.lookup('group')
+        with self.assertRaises(locker.LockerNotSupportedError):
+            locker.lookup('weird')
+        with self.assertRaises(locker.LockerNotFoundError):
+            locker.lookup('missing')
+
+    def test_invalid(self):
+        self.writeDump(['group AFS /afs/test/group w /mit/group 1',
+                        'group AFS /afs/test/group2 w /mit/group'])
+        resolver = locker.FilsysIndexResolver(self.dump)
+        with self.assertRaises(ValueError):
+            locker.HesiodResolver().resolve('group')
+        with self.assertRaises(locker.LockerError):
+            resolver.resolve('group')
+        self.writeDump(['broken'])
+        with self.assertRaises(locker.LockerError):
+            locker.FilsysIndexResolver(self.dump)
+
+    def test_index_reused(self):
+        self.writeDump(['consult AFS /afs/test/consult w /mit/consult'])
+        locker.FilsysIndexResolver(self.dump)
+        built = os.stat(self.dump + '.index')
+        resolver = locker.FilsysIndexResolver(self.dump)
+        self.assertEqual(os.stat(self.dump + '.index').st_ino, built.st_ino)
+        self.assertMatchesHesiod(resolver, 'consult')
+
+    def test_replaced_with_older_dump(self):
+        now = time.time()
+        self.writeDump(['consult AFS /afs/test/consult w /mit/consult'],
+                       now)
+        old = locker.FilsysIndexResolver(self.dump)
+        # e.g. cp -p from an older copy: new contents, older mtime
+        self.writeDump(['consult AFS /afs/test/new w /mit/consult',
+                        'added AFS /afs/test/added w /mit/added'],
+                       now - 3600)
+        resolver = locker.FilsysIndexResolver(self.dump)
+        for n in ('consult', 'added'):
+            self.assertMatchesHesiod(resolver, n)
+        # And refresh() picks it up in an existing resolver
+        self.assertEqual(old.resolve('consult')[0]['data'],
+                         '/afs/test/consult w /mit/consult')
+        old.refresh()
+        for n in ('consult', 'added'):
+            self.assertMatchesHesiod(old, n)
+
+    def test_cache_fallback(self):
+        self.writeDump(['consult AFS /afs/test/consult w /mit/consult'])
+        resolver = locker.FilsysIndexResolver(self.dump,
+                                              '/dev/null/filsys.index')
+        cached = os.listdir(os.path.join(os.environ['XDG_CACHE_HOME'],
+                                         'locker'))
+        self.assertEqual(len(cached), 1)
+        self.assertMatchesHesiod(resolver, 'consult')
+
+    def test_memory_fallback(self):
+        self.writeDump(['consult AFS /afs/test/consult w /mit/consult'])
+        os.environ['XDG_CACHE_HOME'] = '/dev/null/cache'
+        resolver = locker.FilsysIndexResolver(self.dump,
+                                              '/dev/null/filsys.index')
+        self.assertMatchesHesiod(resolver, 'consult')
+        self.assertMatchesHesiod(resolver, 'missing')
+
+    def test_default_resolver(self):
+        self.writeDump(['consult AFS /afs/test/consult w /mit/consult'])
+        os.environ['LOCKER_FILSYS_DUMP'] = self.dump
+        locker.setResolver(None)
+        self.assertTrue(isinstance(locker.getResolver(),
+                                   locker.FilsysIndexResolver))
+        self.assertEqual(locker.lookup('consult')[0].path,
+                         '/afs/test/consult')
+
+    def test_default_resolver_fails(self):
+        os.environ['LOCKER_FILSYS_DUMP'] = os.path.join(self.tmpdir,
+                                                        'missing')
+        locker.setResolver(None)
+        with self.assertRaises(locker.LockerError) as first:
+            locker.resolve('consult')
+        # The dump is not retried (and the error not made again) for
+        # every lookup
+        self.writeDump(['consult AFS /afs/test/consult w /mit/consult'])
+        os.rename(self.dump, os.environ['LOCKER_FILSYS_DUMP'])
+        with self.assertRaises(locker.LockerError) as second:
+            locker.resolve('consult')
+        self.assertTrue(first.exception is second.exception)
+        locker.setResolver(None)
+        self.assertEqual(locker.resolve('consult')[0]['type'], 'AFS')
+
+class HostTestCase(LockerTestCase):
+    def setUp(self):
+        LockerTestCase.setUp(self)
+        self.dns = StubDNS()
+        self.saved['gethostbyname_ex'] = socket.gethostbyname_ex
+        self.saved['gethostbyaddr'] = socket.gethostbyaddr
+        socket.gethostbyname_ex = self.dns.gethostbyname_ex
+        socket.gethostbyaddr = self.dns.gethostbyaddr
+
+    def tearDown(self):
+        socket.gethostbyname_ex = self.saved.pop('gethostbyname_ex')
+        socket.gethostbyaddr = self.saved.pop('gethostbyaddr')
+        LockerTestCase.tearDown(self)
+
+    def index(self, servers):
+        lockers = {}
+        for (name, hosts) in servers.items():
+            self.afs.servers['/afs/test/' + name] = hosts
+            lockers['/mit/' + name] = afsLocker(name)
+        return locker.FileServerIndex(lockers, hostCache=locker.HostCache())
+
+    def test_cached(self):
+        cache = locker.HostCache()
+        for i in range(3):
+            self.assertEqual(cache.lookup('FS1.test')[2], ['10.0.0.1'])
+            self.assertEqual(cache.reverse('10.0.0.1')[0], 'fs1.test')
+            with self.assertRaises(socket.error):
+                cache.lookup('elsewhere.test')
+            with self.assertRaises(socket.error):
+                cache.reverse('10.0.0.9')
+        self.assertEqual(self.dns.forward, {'fs1.test': 1,
+                                            'elsewhere.test': 1})
+        self.assertEqual(self.dns.reverse, {'10.0.0.1': 1, '10.0.0.9': 1})
+
+    def test_expired(self):
+        cache = locker.HostCache(ttl=0)
+        cache.lookup('fs1.test')
+        cache.lookup('fs1.test')
+        self.assertEqual(self.dns.forward, {'fs1.test': 2})
+
+    def test_identities(self):
+        cache = locker.HostCache()
+        self.assertEqual(cache.identities('AFSDB1.test'),
+                         set(['afsdb1.test', 'fs1.test', '10.0.0.1']))
+        # Addresses are looked up by name too
+        self.assertEqual(cache.identities('10.0.0.2'),
+                         set(['fs2.test', '10.0.0.2']))
+        self.assertEqual(cache.identities('10.0.0.9'), set(['10.0.0.9']))
+        self.assertEqual(cache.identities('Elsewhere.test'),
+                         set(['elsewhere.test']))
+        with self.assertRaises(locker.LockerError):
+            cache.identities('elsewhere.test', strict=True)
+
+    def test_index(self):
+        index = self.index({'a': ['FS1.TEST'],
+                            'b': ['FS1.TEST', 'FS2.TEST'],
+                            'c': ['FS2.TEST']})
+        self.assertEqual(index.servers(), ['fs1.test', 'fs2.test'])
+        self.assertEqual(index.lockersFor(['fs1.test', 'fs2.test']),
+                         set(['/mit/a', '/mit/b', '/mit/c']))
+        self.assertEqual(index.unknown, {})
+
+    def test_lockers_on(self):
+        index = self.index({'a': ['FS1.TEST'],
+                            'b': ['FS1.TEST', 'FS2.TEST'],
+                            'c': ['FS2.TEST']})
+        for host in ('FS1.test', 'afsdb1.test', '10.0.0.1'):
+            self.assertEqual(index.lockersOn(host),
+                             set(['/mit/a', '/mit/b']))
+        # The file servers matched outright, so were never looked up
+        self.assertFalse('fs2.test' in self.dns.forward)
+        self.assertEqual(self.dns.forward['fs1.test'], 1)
+        with self.assertRaises(locker.LockerError):
+            index.lockersOn('elsewhere.test')
+
+    def test_lockers_on_by_address(self):
+        index = self.index({'a': ['FS1.INTERNAL.TEST'],
+                            'b': ['FS2.INTERNAL.TEST'],
+                            'c': ['FS9.INTERNAL.TEST']})
+        self.assertEqual(index.lockersOn('fs1.test'), set(['/mit/a']))
+        self.assertEqual(index.lockersOn('10.0.0.2'), set(['/mit/b']))
+        # Each file server was looked up once, and only once
+        self.assertEqual(self.dns.forward['fs1.internal.test'], 1)
+        self.assertEqual(self.dns.forward['fs2.internal.test'], 1)
+        self.assertEqual(self.dns.forward['fs9.internal.test'], 1)
+
+    def test_unknown(self):
+        error = locker.LockerUnavailableError('d', 'No file servers.')
+        lockers = {
+            '/mit/a': afsLocker('a'),
+            '/mit/d': BrokenLocker(error),
+            '/mit/loc': locker.LOCLocker('loc', '/tmp n /mit/loc'),
+        }
+        index = locker.FileServerIndex(lockers, hostCache=locker.HostCache())
+        # Lockers without file servers are not unknown, just skipped
+        self.assertEqual(index.unknown, {'/mit/d': error})
+        self.assertEqual(index.lockersOn('fs1.test'), set(['/mit/a']))
+        lockers['/mit/e'] = BrokenLocker(RuntimeError('bug'))
+        with self.assertRaises(RuntimeError):
+            locker.FileServerIndex(lockers)
+
+if __name__ == '__main__':
+    unittest.main()